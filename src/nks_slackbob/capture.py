@@ -0,0 +1,186 @@
+"""Opptak av hendelser fra Slack og strømmer fra KBS.
+
+Opptak skrives som linjeseparert JSON der hver linje tilhører en sesjon, det vil
+si ett kall til en av hendelseshåndtererne i `main`. Tidspunkt oppgis i sekunder
+relativt til starten av sesjonen slik at opptaket kan spilles av igjen med
+`nks_slackbob.replay`. Hemmeligheter, profilinformasjon og Slack bruker-ID-er blir
+vasket bort før noe skrives til fil.
+"""
+
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import hashlib
+import json
+import pathlib
+import re
+import secrets
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterator
+from typing import Any
+
+from slack_sdk import WebClient
+
+USER_ID_PATTERN: re.Pattern[str] = re.compile(r"\b[UW](?=[A-Z0-9]*[0-9])[A-Z0-9]{8,}\b")
+"""Mønster for å kjenne igjen Slack bruker-ID-er"""
+
+SECRET_PATTERN: re.Pattern[str] = re.compile(r"\b(?:xox[a-z]|xapp)-[A-Za-z0-9-]+")
+"""Mønster for å kjenne igjen Slack tokens"""
+
+SECRET_KEYS: frozenset[str] = frozenset(
+    {"token", "authorization", "access_token", "client_secret"}
+)
+"""Nøkler som aldri skal skrives til et opptak"""
+
+PROFILE_KEYS: frozenset[str] = frozenset(
+    {
+        "user_profile",
+        "bot_profile",
+        "real_name",
+        "real_name_normalized",
+        "display_name",
+        "display_name_normalized",
+        "first_name",
+        "last_name",
+        "username",
+    }
+)
+"""Nøkler med personopplysninger som ikke skal skrives til et opptak"""
+
+
+class Recorder:
+    """Skriv opptak til en linjeseparert JSON fil.
+
+    Bruker-ID-er erstattes med pseudonymer som er stabile innenfor ett opptak,
+    men som ikke kan spores tilbake til brukeren siden saltet kun finnes i
+    minnet.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        """Åpne fil for opptak, nye linjer legges til på slutten av filen."""
+        self._file = path.open("a", encoding="utf-8", buffering=1)
+        self._lock = threading.Lock()
+        self._salt = secrets.token_bytes(16)
+
+    def _pseudonym(self, match: re.Match[str]) -> str:
+        """Lag et stabilt pseudonym for en bruker-ID."""
+        digest = hashlib.sha256(self._salt + match.group(0).encode()).hexdigest()
+        return f"{match.group(0)[0]}{digest[:10].upper()}"
+
+    def scrub(self, value: Any) -> Any:
+        """Fjern hemmeligheter, personopplysninger og bruker-ID-er fra en verdi."""
+        if isinstance(value, str):
+            value = re.sub(SECRET_PATTERN, "<secret>", value)
+            return re.sub(USER_ID_PATTERN, self._pseudonym, value)
+        if isinstance(value, dict):
+            return {
+                k: self.scrub(v)
+                for k, v in value.items()
+                if k not in SECRET_KEYS and k not in PROFILE_KEYS
+            }
+        if isinstance(value, list | tuple):
+            return [self.scrub(v) for v in value]
+        return value
+
+    def write(self, record: dict[str, Any]) -> None:
+        """Vask og skriv én linje til opptaket."""
+        line = json.dumps(self.scrub(record), ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            # Opptaket kan ha blitt lukket mens en hendelse ble håndtert
+            if not self._file.closed:
+                self._file.write(line + "\n")
+
+    def close(self) -> None:
+        """Lukk filen opptaket skrives til."""
+        with self._lock:
+            self._file.close()
+
+
+@dataclasses.dataclass(frozen=True)
+class Session:
+    """Én hendelse fra Slack og alt som skjer mens den besvares."""
+
+    id: str
+    """Unik ID for sesjonen"""
+
+    start: float = dataclasses.field(default_factory=time.monotonic)
+    """Monotont tidspunkt sesjonen startet"""
+
+
+_recorder: Recorder | None = None
+"""Aktivt opptak, `None` betyr at opptak er skrudd av"""
+
+_session: contextvars.ContextVar[Session | None] = contextvars.ContextVar(
+    "capture_session", default=None
+)
+"""Sesjonen som hører til tråden som håndterer en hendelse"""
+
+
+def setup_capture(path: pathlib.Path) -> None:
+    """Skru på opptak til gitt fil."""
+    global _recorder
+    _recorder = Recorder(path)
+
+
+def close_capture() -> None:
+    """Skru av opptak og lukk filen det ble skrevet til."""
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
+
+
+def record(kind: str, **data: Any) -> None:
+    """Skriv en hendelse i gjeldende sesjon til opptaket.
+
+    Funksjonen gjør ingenting hvis opptak er skrudd av eller vi ikke er inne i
+    en sesjon.
+    """
+    # MERK: Les '_recorder' én gang siden den kan bli satt til `None` av
+    # 'close_capture' fra en annen tråd
+    recorder = _recorder
+    current = _session.get()
+    if recorder is None or current is None:
+        return
+    recorder.write(
+        {
+            "session": current.id,
+            "t": round(time.monotonic() - current.start, 4),
+            "kind": kind,
+            **data,
+        }
+    )
+
+
+@contextlib.contextmanager
+def session(handler: str, event: dict[str, Any]) -> Iterator[None]:
+    """Start en ny sesjon og ta opp hendelsen som startet den."""
+    if _recorder is None:
+        yield
+        return
+    token = _session.set(Session(id=uuid.uuid4().hex[:12]))
+    try:
+        record("event", handler=handler, event=event)
+        yield
+    finally:
+        _session.reset(token)
+
+
+def captured(
+    func: Callable[[dict[str, str], WebClient], None],
+) -> Callable[[dict[str, str], WebClient], None]:
+    """Dekorator som tar opp alle kall til en hendelseshåndterer.
+
+    MERK: Slack bolt ser på navnet til argumentene for å bestemme hva som
+    sendes inn, `functools.wraps` sørger for at signaturen blir bevart.
+    """
+
+    @functools.wraps(func)
+    def wrapper(event: dict[str, str], client: WebClient) -> None:
+        with session(func.__name__, event):
+            func(event, client)
+
+    return wrapper
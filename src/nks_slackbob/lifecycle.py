@@ -0,0 +1,149 @@
+"""Livssyklus for boten ved oppstart, omstart og avslutning.
+
+Ved utrulling på NAIS startes en ny pod før den gamle stoppes. For at det ikke
+skal oppstå et hull hvor ingen tar imot hendelser fra Slack melder boten seg
+først klar når socket-en mot Slack er koblet til. Den gamle poden får deretter
+SIGTERM, kobler fra Slack og lar pågående svar bli ferdige innen en frist.
+
+Svar som ikke blir ferdige innen fristen blir bedt om å avbryte. Henger de
+fortsatt, for eksempel i påvente av KBS, sender hovedtråden siste oppdatering
+til Slack på vegne av dem før prosessen avsluttes.
+"""
+
+import functools
+import threading
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import structlog
+from slack_sdk import WebClient
+
+ABORT_GRACE: float = 5.0
+"""Sekunder avbrutte svar får på å sende siste oppdatering til Slack"""
+
+
+class InFlight:
+    """Hold oversikt over hendelser som er under behandling."""
+
+    def __init__(self) -> None:
+        """Opprett teller uten pågående hendelser."""
+        self._count = 0
+        self._cond = threading.Condition()
+        self._finalizers: dict[int, Callable[[], None]] = {}
+        self.aborted = threading.Event()
+        """Satt når pågående svar skal avbrytes og avsluttes så fort som mulig"""
+
+    @property
+    def count(self) -> int:
+        """Antall hendelser under behandling."""
+        with self._cond:
+            return self._count
+
+    def tracked(
+        self, func: Callable[[dict[str, str], WebClient], None]
+    ) -> Callable[[dict[str, str], WebClient], None]:
+        """Dekorator som teller kall til en hendelseshåndterer som pågående."""
+
+        @functools.wraps(func)
+        def wrapper(event: dict[str, str], client: WebClient) -> None:
+            with self._cond:
+                self._count += 1
+            try:
+                func(event, client)
+            finally:
+                with self._cond:
+                    self._finalizers.pop(threading.get_ident(), None)
+                    self._count -= 1
+                    self._cond.notify_all()
+
+        return wrapper
+
+    def drain(self, timeout: float) -> bool:
+        """Vent på at alle pågående hendelser blir ferdige.
+
+        Returnerer `False` hvis det fortsatt er hendelser under behandling når
+        fristen går ut.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._count == 0, timeout=timeout)
+
+    def abort(self, grace: float = ABORT_GRACE) -> bool:
+        """Be pågående svar om å avslutte og vent kort på at de gjør det."""
+        self.aborted.set()
+        return self.drain(grace)
+
+    def on_abort(self, func: Callable[[], None]) -> None:
+        """Registrer hvordan svaret i gjeldende tråd avsluttes ved avbrudd.
+
+        Funksjonen kalles av `finalize` hvis hendelseshåndtereren ikke blir
+        ferdig selv, og må derfor kunne kalles fra en annen tråd.
+        """
+        with self._cond:
+            self._finalizers[threading.get_ident()] = func
+
+    def claim(self) -> Callable[[], None] | None:
+        """Ta tilbake avslutningen registrert for gjeldende tråd.
+
+        Returnerer `None` hvis `finalize` allerede har avsluttet svaret, da skal
+        ikke hendelseshåndtereren oppdatere svaret igjen.
+        """
+        with self._cond:
+            return self._finalizers.pop(threading.get_ident(), None)
+
+    def finalize(self) -> int:
+        """Avslutt alle svar som fortsatt pågår og returner hvor mange det var."""
+        with self._cond:
+            finalizers = list(self._finalizers.values())
+            self._finalizers.clear()
+        for func in finalizers:
+            try:
+                func()
+            except Exception:
+                structlog.get_logger("slackbob").exception(
+                    "Klarte ikke å avslutte svar ved avbrudd"
+                )
+        return len(finalizers)
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    """Svar på helsesjekker fra NAIS."""
+
+    server: "HealthServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        """Ikke skriv ut hver helsesjekk."""
+
+    def do_GET(self) -> None:
+        """Svar på `/isalive` og `/isready`."""
+        match self.path:
+            case "/isalive":
+                status = 200
+            case "/isready":
+                ready = not self.server.stopping.is_set() and self.server.connected()
+                status = 200 if ready else 503
+            case _:
+                status = 404
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class HealthServer(ThreadingHTTPServer):
+    """HTTP-server for helsesjekker som kjører i bakgrunnen."""
+
+    def __init__(self, port: int, connected: Callable[[], bool]) -> None:
+        """Opprett server, `connected` sier om vi er koblet til Slack."""
+        super().__init__(("0.0.0.0", port), _HealthHandler)
+        self.connected = connected
+        self.stopping = threading.Event()
+        """Satt når boten avslutter, da melder vi oss ikke lenger klare"""
+
+    def start(self) -> None:
+        """Start serveren i en egen tråd."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        """Stopp serveren og frigjør porten."""
+        self.shutdown()
+        self.server_close()
@@ -3,9 +3,14 @@
 import datetime
 import functools
 import json
+import logging
+import os
 import random
 import re
+import signal
+import threading
 import uuid
+from typing import Any
 
 import httpx
 import structlog
@@ -13,10 +18,11 @@ from pydantic_core import Url
 from slack_bolt import App
 from slack_sdk import WebClient
 
-from . import settings
+from . import capture, settings
 from .auth import OAuth2Flow
 from .blocks import message_blocks
 from .expressions import WORKING_ON_ANSWER
+from .lifecycle import HealthServer, InFlight
 from .logging import setup_logging
 from .utils import (
     USERNAME_PATTERN,
@@ -32,6 +38,10 @@ API_URL = httpx.URL(str(settings.kbs_endpoint))
 # Set opp logging med structlog
 setup_logging()
 
+# Skru på opptak hvis det er konfigurert
+if settings.capture_file is not None:
+    capture.setup_capture(settings.capture_file)
+
 # Set opp autentisering
 auth = OAuth2Flow(
     client_id=settings.client_id,
@@ -43,7 +53,15 @@ auth = OAuth2Flow(
 )
 
 # Sett opp Slack app for å koble til Slack
-app = App(token=settings.bot_token.get_secret_value())
+app = App(
+    client=WebClient(
+        token=settings.bot_token.get_secret_value(),
+        base_url=str(settings.slack_api_url),
+    )
+)
+
+inflight = InFlight()
+"""Hendelser under behandling, brukes for å avslutte uten å miste svar"""
 
 
 def chat(client: WebClient, event: dict[str, str]) -> None:
@@ -57,6 +75,7 @@ def chat(client: WebClient, event: dict[str, str]) -> None:
     # Hent ut samtale historie før vi svarer ut noe
     thread = event.get("thread_ts", event["ts"])
     chat_hist = client.conversations_replies(channel=event["channel"], ts=thread)
+    capture.record("replies", messages=chat_hist.get("messages"))
     # Start med å svare at vi jobber med et svar til bruker
     temp_msg = client.chat_postMessage(
         text=random.choice(WORKING_ON_ANSWER),
@@ -71,19 +90,51 @@ def chat(client: WebClient, event: dict[str, str]) -> None:
         channel=temp_msg.get("channel"),  # type: ignore[arg-type]
         ts=temp_msg.get("ts"),  # type: ignore[arg-type]
     )
+    reply: dict[str, Any] = {}
+    request_id = uuid.uuid4().hex
+
+    def finish_aborted() -> None:
+        """Avslutt svaret med det vi har fått så langt når boten starter på nytt."""
+        if not reply.get("answer", {}).get("text"):
+            update_msg(
+                text=f"Jeg startet på nytt før svaret var klart, prøv igjen (ID: {request_id}) :recycle:"
+            )
+            return
+        partial = {
+            **reply,
+            "answer": {
+                **reply["answer"],
+                "text": reply["answer"]["text"]
+                + "\n\n_Svaret ble avbrutt fordi jeg starter på nytt, prøv igjen om litt_",
+            },
+        }
+        update_msg(
+            text=markdown_to_slack(partial["answer"]["text"]),
+            blocks=message_blocks(partial),
+        )
+
+    def finish_msg(**kwargs: Any) -> None:
+        """Send siste oppdatering, med mindre hovedtråden allerede har gjort det."""
+        if inflight.claim() is not None:
+            update_msg(**kwargs)
+
+    # Ved avslutning kan hovedtråden sende siste oppdatering for oss hvis vi
+    # henger, slik at meldingen ikke blir stående som "La meg nå se...". Alle
+    # avsluttende oppdateringer under går derfor gjennom 'finish_msg'
+    inflight.on_abort(finish_aborted)
     # Sjekk tidlig om API-et kjører, slik at bruker slipper å vente
     if not is_bob_alive(API_URL):
         log.info("'/is_alive' endepunktet til KBS-en svarte ikke")
-        update_msg(text="Kunnskapsbasen kjører ikke akkurat nå :construction:")
+        finish_msg(text="Kunnskapsbasen kjører ikke akkurat nå :construction:")
         return
     # Hent ut chat historikk og spørsmål fra brukeren
     history = [convert_msg(msg) for msg in chat_hist.get("messages")[:-1]]  # type: ignore[index]
     question = strip_msg(event["text"])
-    reply = {}
+    interrupted = False
     # Send spørsmål til NKS KBS
-    request_id = uuid.uuid4().hex
     try:
         log = log.bind(request_id=request_id)
+        capture.record("kbs_request")
         with httpx.stream(
             "POST",
             API_URL.copy_with(path="/api/v1/stream/chat"),
@@ -94,13 +145,14 @@ def chat(client: WebClient, event: dict[str, str]) -> None:
             json={"history": history, "question": question},
             timeout=settings.answer_timeout,
         ) as r:
+            capture.record("kbs_status", status=r.status_code)
             if r.status_code != 200:
                 log.error(
                     "KBS svarte ikke som forventet",
                     status_code=r.status_code,
                     reason=r.reason_phrase,
                 )
-                update_msg(
+                finish_msg(
                     text=f"Ånei! Noe gikk galt for kunnskapsbasen :scream: (ID: {request_id})"
                 )
                 return
@@ -109,7 +161,14 @@ def chat(client: WebClient, event: dict[str, str]) -> None:
             last_update = datetime.datetime.now()
             log.info("Strømmer svar til bruker")
             for line in r.iter_lines():
+                # Ved avslutning som har gått over fristen avbryter vi og sender
+                # det vi har fått så langt
+                if inflight.aborted.is_set():
+                    log.warning("Avbryter strømming av svar på grunn av avslutning")
+                    interrupted = True
+                    break
                 if line.startswith("data: "):
+                    capture.record("kbs", frame=line)
                     _, data = line.split(" ", maxsplit=1)
                     reply = json.loads(data)
                     now = datetime.datetime.now()
@@ -127,22 +186,36 @@ def chat(client: WebClient, event: dict[str, str]) -> None:
             "Spørring mot kunnskapbasen tok for lang tid",
             timeout=settings.answer_timeout,
         )
-        update_msg(text=f"Kunnskapsbasen svarer ikke (ID: {request_id}) :shrug:")
+        finish_msg(text=f"Kunnskapsbasen svarer ikke (ID: {request_id}) :shrug:")
         return
     except json.decoder.JSONDecodeError as e:
         log.error(
             "Klarte ikke å dekode JSON svar fra KBS", kbs_data=data, exception=str(e)
         )
-        update_msg(text=f"Kunnskapsbasen snakker i tunger (ID: {request_id}) :ghost:")
+        finish_msg(text=f"Kunnskapsbasen snakker i tunger (ID: {request_id}) :ghost:")
+        return
+    if interrupted:
+        # Hvis hovedtråden allerede har avsluttet svaret skal vi ikke
+        # overskrive det
+        if inflight.claim() is not None:
+            finish_aborted()
+        return
+    if not reply.get("answer", {}).get("text"):
+        log.warning("Fikk ikke noe svar fra KBS")
+        finish_msg(
+            text=f"Fikk ikke noe svar fra kunnskapsbasen, prøv igjen (ID: {request_id}) :recycle:"
+        )
         return
     log.info("Svarer bruker fra KBS")
     # Hent respons fra KBS og formater det for Slack
-    update_msg(
+    finish_msg(
         text=markdown_to_slack(reply["answer"]["text"]), blocks=message_blocks(reply)
     )
 
 
 @app.event("app_mention")
+@inflight.tracked
+@capture.captured
 def slack_mention(event: dict[str, str], client: WebClient) -> None:
     """Håndter @bot meldinger på Slack."""
     structlog.get_logger("slackbob").info(
@@ -156,6 +229,8 @@ def slack_mention(event: dict[str, str], client: WebClient) -> None:
 
 
 @app.event("message")
+@inflight.tracked
+@capture.captured
 def thread_reply(event: dict[str, str], client: WebClient) -> None:
     """Håndter svar i tråder boten har besvart."""
     log = structlog.get_logger("slackbob").bind(
@@ -175,6 +250,11 @@ def thread_reply(event: dict[str, str], client: WebClient) -> None:
     # prosessering her blir det to svar i tråden
     for username in re.findall(USERNAME_PATTERN, event["text"]):
         user = client.users_info(user=username)
+        capture.record(
+            "user",
+            user=username,
+            api_app_id=user.get("user")["profile"].get("api_app_id"),  # type: ignore[index]
+        )
         if user.get("user")["profile"].get("api_app_id") == settings.id:  # type: ignore[index]
             return
     # Sjekk om det er en direkte melding til boten, hvis det er det OG det ikke
@@ -191,6 +271,7 @@ def thread_reply(event: dict[str, str], client: WebClient) -> None:
     history = client.conversations_replies(
         channel=event["channel"], ts=event["thread_ts"]
     )
+    capture.record("replies", messages=history.get("messages"))
     we_replied = any(
         [
             msg["app_id"] == settings.id
@@ -205,16 +286,63 @@ def thread_reply(event: dict[str, str], client: WebClient) -> None:
     chat(client, event)
 
 
+def _exit_on_signal(signals: set[signal.Signals]) -> None:
+    """Avslutt prosessen umiddelbart når et av signalene kommer."""
+    signum = signal.sigwait(signals)
+    os._exit(128 + signum)
+
+
 def main() -> None:
-    """Inngangsporten til Slack boten."""
+    """Inngangsporten til Slack boten.
+
+    Boten melder seg klar på `/isready` først når den er koblet til Slack, slik
+    at en ny pod tar imot hendelser før den gamle kobler fra. Ved SIGTERM kobler
+    vi fra Slack og venter på at pågående svar blir ferdige før vi avslutter.
+    """
     from slack_bolt.adapter.socket_mode import SocketModeHandler
 
-    try:
-        SocketModeHandler(app, app_token=settings.app_token.get_secret_value()).start()  # type: ignore[no-untyped-call]
-    except KeyboardInterrupt:
-        # Ignorer fordi det betyr at vi tester på kommandolinje og trenger ikke
-        # beskjed at noe feilet
-        pass
+    # Signaler blokkeres før noen tråder startes, slik at de arver masken og
+    # signalene kun blir levert til 'signal.sigwait' under. Dermed rører vi
+    # aldri låser fra en signalhåndterer
+    signals = {signal.SIGTERM, signal.SIGINT}
+    signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+    log = structlog.get_logger("slackbob")
+    handler = SocketModeHandler(app, app_token=settings.app_token.get_secret_value())  # type: ignore[no-untyped-call]
+    health = HealthServer(settings.health_port, connected=handler.client.is_connected)
+    health.start()
+    handler.connect()  # type: ignore[no-untyped-call]
+    log.info("Koblet til Slack")
+    # Ctrl+C på kommandolinjen og SIGTERM fra NAIS behandles likt
+    signum = signal.sigwait(signals)
+    health.stopping.set()
+    # Et andre signal, for eksempel Ctrl+C to ganger, avslutter umiddelbart
+    threading.Thread(target=_exit_on_signal, args=(signals,), daemon=True).start()
+    # Slutt å ta imot nye hendelser, hendelser Slack ikke har fått bekreftet
+    # blir sendt til en annen tilkobling
+    log.info("Avslutter, kobler fra Slack", signal=signum, in_flight=inflight.count)
+    handler.close()  # type: ignore[no-untyped-call]
+    if not inflight.drain(settings.shutdown_timeout):
+        log.warning(
+            "Pågående svar ble ikke ferdige innen fristen, avbryter",
+            in_flight=inflight.count,
+            timeout=settings.shutdown_timeout,
+        )
+        if not inflight.abort():
+            finalized = inflight.finalize()
+            log.error(
+                "Pågående svar henger, sendte siste oppdatering fra hovedtråden",
+                in_flight=inflight.count,
+                finalized=finalized,
+            )
+            # Tråder som venter på KBS holder ellers prosessen i live til
+            # 'answer_timeout' går ut, forbi fristen NAIS gir oss. Opptaket
+            # lukkes ikke siden trådene fortsatt kan skrive til det
+            health.stop()
+            logging.shutdown()
+            os._exit(1)
+    capture.close_capture()
+    health.stop()
+    log.info("Avsluttet")
 
 
 if __name__ == "__main__":
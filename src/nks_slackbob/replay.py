@@ -0,0 +1,471 @@
+"""Avspilling av opptak mot lokale stubber for å måle ytelse.
+
+Et opptak fra `nks_slackbob.capture` spilles av sesjon for sesjon gjennom de
+samme hendelseshåndtererne som kjører i produksjon. Slack erstattes med en
+stubbklient i minnet og KBS erstattes med en lokal HTTP-server som strømmer de
+opptatte `data:` meldingene med samme tidsavstand, eventuelt akselerert.
+
+Resultatet fra en kjøring kan lagres og brukes som sammenligningsgrunnlag for en
+senere kjøring, for eksempel mellom to versjoner av koden:
+
+```bash
+uv run nks-slackbob-replay opptak.jsonl --output før.json
+git checkout min-gren
+uv run nks-slackbob-replay opptak.jsonl --baseline før.json
+```
+
+Ved akselerert avspilling skaleres også rate-limit for oppdateringer til Slack
+og tidsbegrensningen mot KBS, slik at antall oppdateringer blir det samme som i
+sanntid. Sammenlign likevel kun kjøringer med samme hastighet, siden tiden koden
+selv bruker ikke blir akselerert.
+"""
+
+import argparse
+import contextlib
+import dataclasses
+import json
+import pathlib
+import statistics
+import threading
+import time
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, cast
+
+import httpx
+from pydantic_core import Url
+from slack_sdk import WebClient
+
+from . import settings
+
+LATENCY_TOLERANCE: float = 0.1
+"""Minste endring i sekunder, eller andel, før en sesjon regnes som endret"""
+
+
+@dataclasses.dataclass
+class Script:
+    """Alt som ble tatt opp i én sesjon."""
+
+    session: str
+    """ID for sesjonen i opptaket"""
+
+    handler: str
+    """Navn på hendelseshåndtereren som mottok hendelsen"""
+
+    event: dict[str, Any]
+    """Hendelsen fra Slack"""
+
+    replies: list[dict[str, Any]] = dataclasses.field(default_factory=list)
+    """Svar fra `conversations_replies` i den rekkefølgen de ble hentet"""
+
+    users: dict[str, str | None] = dataclasses.field(default_factory=dict)
+    """Slack app ID for brukere slått opp med `users_info`"""
+
+    kbs_request: float | None = None
+    """Tidspunkt spørsmålet ble sendt til KBS"""
+
+    kbs_status: tuple[float, int] | None = None
+    """Tidspunkt og statuskode for svaret fra KBS"""
+
+    kbs_frames: list[tuple[float, str]] = dataclasses.field(default_factory=list)
+    """Tidspunkt og innhold for hver `data:` melding fra KBS"""
+
+
+@dataclasses.dataclass
+class Result:
+    """Målinger fra avspilling av én sesjon."""
+
+    session: str
+    """ID for sesjonen i opptaket"""
+
+    handler: str
+    """Navn på hendelseshåndtereren som mottok hendelsen"""
+
+    updates: int = 0
+    """Antall kall til `chat_update`"""
+
+    first_update: float | None = None
+    """Sekunder fra hendelsen til første `chat_update`"""
+
+    last_update: float | None = None
+    """Sekunder fra hendelsen til siste `chat_update`"""
+
+    error: str | None = None
+    """Feilmelding hvis hendelseshåndtereren feilet"""
+
+
+def load(path: pathlib.Path) -> tuple[list[Script], int]:
+    """Les inn et opptak og grupper det per sesjon.
+
+    Linjer som ikke kan leses hoppes over, for eksempel en avkuttet siste linje
+    fra en prosess som ble drept. Returnerer sesjonene og antall linjer som ble
+    hoppet over.
+    """
+    scripts: dict[str, Script] = {}
+    skipped = 0
+    with path.open(encoding="utf-8") as fil:
+        for line in fil:
+            if not line.strip():
+                continue
+            try:
+                _add_record(scripts, json.loads(line))
+            except (json.JSONDecodeError, KeyError, TypeError):
+                skipped += 1
+    return list(scripts.values()), skipped
+
+
+def _add_record(scripts: dict[str, Script], rec: dict[str, Any]) -> None:
+    """Legg til én linje fra opptaket i sesjonen den tilhører."""
+    if rec["kind"] == "event":
+        scripts[rec["session"]] = Script(
+            session=rec["session"], handler=rec["handler"], event=rec["event"]
+        )
+        return
+    # Sesjoner hvor starten mangler, for eksempel fordi opptaket ble skrudd på
+    # midt i en sesjon, hopper vi over
+    script = scripts.get(rec["session"])
+    if script is None:
+        return
+    match rec["kind"]:
+        case "replies":
+            script.replies.append({"ok": True, "messages": rec["messages"]})
+        case "user":
+            script.users[rec["user"]] = rec["api_app_id"]
+        case "kbs_request":
+            script.kbs_request = rec["t"]
+        case "kbs_status":
+            script.kbs_status = (rec["t"], rec["status"])
+        case "kbs":
+            script.kbs_frames.append((rec["t"], rec["frame"]))
+
+
+class StubClient:
+    """Stubb for `slack_sdk.WebClient` som svarer fra et opptak."""
+
+    def __init__(self, script: Script, result: Result) -> None:
+        """Opprett stubb for én sesjon."""
+        self._script = script
+        self._replies = iter(script.replies)
+        self._result = result
+        self._start = time.monotonic()
+        self.messages: list[str | None] = []
+        """Tekst fra hver `chat_update` i den rekkefølgen de ble sendt"""
+
+    def conversations_replies(self, **kwargs: Any) -> dict[str, Any]:
+        """Svar med neste opptatte samtalehistorikk."""
+        return next(self._replies, {"ok": True, "messages": []})
+
+    def users_info(self, user: str, **kwargs: Any) -> dict[str, Any]:
+        """Svar med opptatt app ID for brukeren."""
+        return {
+            "ok": True,
+            "user": {
+                "id": user,
+                "profile": {"api_app_id": self._script.users.get(user)},
+            },
+        }
+
+    def chat_postMessage(self, **kwargs: Any) -> dict[str, Any]:
+        """Lat som om meldingen ble sendt."""
+        return {"ok": True, "channel": kwargs.get("channel"), "ts": "0000000000.000000"}
+
+    def chat_update(self, **kwargs: Any) -> dict[str, Any]:
+        """Mål tidspunkt for oppdatering av meldingen."""
+        now = round(time.monotonic() - self._start, 4)
+        self._result.updates += 1
+        if self._result.first_update is None:
+            self._result.first_update = now
+        self._result.last_update = now
+        self.messages.append(kwargs.get("text"))
+        return {"ok": True, "channel": kwargs.get("channel"), "ts": kwargs.get("ts")}
+
+
+class StubServer(ThreadingHTTPServer):
+    """Lokal HTTP-server som står i for KBS, Entra ID og Slack sin `auth.test`."""
+
+    def __init__(self, speed: float) -> None:
+        """Start server på en ledig port på localhost."""
+        super().__init__(("127.0.0.1", 0), _StubHandler)
+        self.speed = speed
+        self.script: Script | None = None
+
+    @property
+    def url(self) -> str:
+        """Adressen serveren lytter på."""
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Håndter forespørsler mot `StubServer`."""
+
+    server: StubServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        """Ikke skriv ut hver forespørsel."""
+
+    def _json(self, body: dict[str, Any]) -> None:
+        """Svar med JSON."""
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        """Svar på `/is_alive` fra KBS."""
+        if self.path == "/is_alive":
+            self._json({"alive": True})
+        else:
+            self.send_error(404)
+
+    def do_POST(self) -> None:
+        """Svar på token, `auth.test` og strømming av svar fra KBS."""
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/token":
+            self._json({"access_token": "replay", "expires_in": 3600})
+        elif self.path == "/api/auth.test":
+            self._json(
+                {
+                    "ok": True,
+                    "url": "https://replay.slack.com/",
+                    "team": "replay",
+                    "user": "replay",
+                    "team_id": "T00000000",
+                    "user_id": "U00000000",
+                    "bot_id": "B00000000",
+                    "is_enterprise_install": False,
+                }
+            )
+        elif self.path == "/api/v1/stream/chat":
+            self._stream()
+        else:
+            self.send_error(404)
+
+    def _stream(self) -> None:
+        """Strøm opptatte `data:` meldinger med samme tidsavstand som i opptaket."""
+        script = self.server.script
+        speed = self.server.speed
+        if script is None or script.kbs_status is None:
+            self.send_error(503)
+            return
+        start = time.monotonic()
+        origin = script.kbs_request if script.kbs_request is not None else 0.0
+
+        def wait_until(t: float) -> None:
+            delay = start + (t - origin) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        status_time, status = script.kbs_status
+        wait_until(status_time)
+        self.send_response(status)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        if status != 200:
+            return
+        for t, frame in script.kbs_frames:
+            wait_until(t)
+            self.wfile.write(f"{frame}\n\n".encode())
+            self.wfile.flush()
+
+
+@contextlib.contextmanager
+def connect_stubs(server: StubServer) -> Iterator[None]:
+    """Pek alle eksterne avhengigheter i `main` mot stubbene.
+
+    Tidsbegrensninger skaleres med avspillingshastigheten slik at antall
+    oppdateringer blir det samme som i sanntid. Alle innstillinger settes
+    tilbake når blokken avsluttes.
+    """
+    saved_settings = {
+        name: getattr(settings, name)
+        for name in (
+            "kbs_endpoint",
+            "auth_token_endpoint",
+            "slack_api_url",
+            "capture_file",
+            "update_rate_limit",
+            "answer_timeout",
+        )
+    }
+    # Innstillingene må settes før `main` importeres siden `main` setter opp
+    # klienter ved import
+    settings.kbs_endpoint = Url(server.url)
+    settings.auth_token_endpoint = Url(f"{server.url}/token")
+    settings.slack_api_url = Url(f"{server.url}/api/")
+    settings.capture_file = None
+    settings.update_rate_limit = saved_settings["update_rate_limit"] / server.speed
+    settings.answer_timeout = saved_settings["answer_timeout"] / server.speed
+    from . import main as bot
+
+    # `main` kan allerede være importert tidligere i samme prosess, og peker da
+    # mot de opprinnelige endepunktene
+    saved_api_url = bot.API_URL
+    saved_token_endpoint = bot.auth.token_endpoint
+    saved_token = bot.auth._token
+    bot.API_URL = httpx.URL(server.url)
+    bot.auth.token_endpoint = Url(f"{server.url}/token")
+    bot.auth._token = {}
+    try:
+        yield
+    finally:
+        for name, value in saved_settings.items():
+            setattr(settings, name, value)
+        bot.API_URL = saved_api_url
+        bot.auth.token_endpoint = saved_token_endpoint
+        bot.auth._token = saved_token
+
+
+def run(scripts: list[Script], speed: float = 1.0) -> list[Result]:
+    """Spill av opptatte sesjoner gjennom hendelseshåndtererne i `main`."""
+    server = StubServer(speed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    results = []
+    try:
+        with connect_stubs(server):
+            from . import main as bot
+
+            handlers = {
+                "slack_mention": bot.slack_mention,
+                "thread_reply": bot.thread_reply,
+            }
+            for script in scripts:
+                server.script = script
+                result = Result(session=script.session, handler=script.handler)
+                try:
+                    # MERK: Slack bolt sine dekoratorer gir tilbake en valgfri
+                    # funksjon, derfor ignorerer vi 'misc' for mypy
+                    handlers[script.handler](  # type: ignore[misc]
+                        script.event, cast(WebClient, StubClient(script, result))
+                    )
+                except Exception as e:
+                    result.error = repr(e)
+                results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def _summary(results: list[dict[str, Any]]) -> dict[str, float | None]:
+    """Regn ut samlede tall for en kjøring."""
+    first = [r["first_update"] for r in results if r["first_update"] is not None]
+    last = [r["last_update"] for r in results if r["last_update"] is not None]
+    return {
+        "updates": sum(r["updates"] for r in results),
+        "errors": sum(1 for r in results if r["error"]),
+        "first_update_median": statistics.median(first) if first else None,
+        "last_update_median": statistics.median(last) if last else None,
+        # MERK: 'inclusive' sørger for at vi ikke ekstrapolerer utover de målte
+        # verdiene når det er få sesjoner i opptaket
+        "last_update_p95": (
+            statistics.quantiles(last, n=20, method="inclusive")[-1]
+            if len(last) > 1
+            else None
+        ),
+    }
+
+
+def report(
+    results: list[dict[str, Any]], baseline: list[dict[str, Any]] | None = None
+) -> str:
+    """Lag en tekstrapport, med differanse mot et sammenligningsgrunnlag."""
+    lines = []
+    summary = _summary(results)
+    before = _summary(baseline) if baseline is not None else {}
+    if baseline is not None:
+        lines.append(f"{'':<22}{'nå':>10}{'før':>10}{'endring':>10}")
+    for key, value in summary.items():
+        line = f"{key:<22}{_fmt(value):>10}"
+        if baseline is not None:
+            line += f"{_fmt(before[key]):>10}{_diff(before[key], value):>10}"
+        lines.append(line)
+    if baseline is None:
+        return "\n".join(lines)
+    # Vis sesjoner hvor antall oppdateringer, feil eller tid endret seg
+    previous = {r["session"]: r for r in baseline}
+    for r in results:
+        old = previous.get(r["session"])
+        if old is None:
+            continue
+        if (
+            old["updates"] != r["updates"]
+            or old["error"] != r["error"]
+            or _latency_changed(old["first_update"], r["first_update"])
+            or _latency_changed(old["last_update"], r["last_update"])
+        ):
+            lines.append(
+                f"{r['session']} ({r['handler']}): oppdateringer "
+                f"{old['updates']} -> {r['updates']}, første oppdatering "
+                f"{_fmt(old['first_update'])} -> {_fmt(r['first_update'])} "
+                f"({_diff(old['first_update'], r['first_update'])}), siste oppdatering "
+                f"{_fmt(old['last_update'])} -> {_fmt(r['last_update'])} "
+                f"({_diff(old['last_update'], r['last_update'])})"
+                + (f", feil: {r['error']}" if r["error"] else "")
+            )
+    return "\n".join(lines)
+
+
+def _latency_changed(before: float | None, after: float | None) -> bool:
+    """Sjekk om en tidsmåling har endret seg mer enn `LATENCY_TOLERANCE`."""
+    if before is None or after is None:
+        return before is not after
+    return abs(after - before) > max(LATENCY_TOLERANCE, LATENCY_TOLERANCE * before)
+
+
+def _fmt(value: float | None) -> str:
+    """Formater et tall for rapporten."""
+    if value is None:
+        return "-"
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+
+def _diff(before: float | None, after: float | None) -> str:
+    """Formater differansen mellom to tall for rapporten."""
+    if before is None or after is None:
+        return "-"
+    return (
+        f"{after - before:+.3f}" if isinstance(after, float) else f"{after - before:+}"
+    )
+
+
+def main() -> None:
+    """Inngangsporten for avspilling av opptak."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture", type=pathlib.Path, help="Opptak å spille av")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="Avspillingshastighet (1 = sanntid)"
+    )
+    parser.add_argument(
+        "--output", type=pathlib.Path, help="Lagre resultatet som JSON til denne filen"
+    )
+    parser.add_argument(
+        "--baseline", type=pathlib.Path, help="Tidligere resultat å sammenligne mot"
+    )
+    args = parser.parse_args()
+
+    # Sjekk sammenligningsgrunnlaget før avspilling siden avspilling i sanntid
+    # kan ta lang tid
+    baseline = None
+    if args.baseline is not None:
+        previous = json.loads(args.baseline.read_text(encoding="utf-8"))
+        if previous["speed"] != args.speed:
+            parser.error(
+                f"Sammenligningsgrunnlaget er spilt av med hastighet {previous['speed']}"
+            )
+        baseline = previous["results"]
+    scripts, skipped = load(args.capture)
+    if skipped:
+        print(f"Hoppet over {skipped} linje(r) i opptaket som ikke kunne leses")
+    results = [dataclasses.asdict(r) for r in run(scripts, speed=args.speed)]
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps({"speed": args.speed, "results": results}, indent=2),
+            encoding="utf-8",
+        )
+    print(report(results, baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 """Innstillinger for prosjektet."""
 
 from datetime import timedelta
+from pathlib import Path
 
 from pydantic import AliasChoices, AnyHttpUrl, Field, SecretStr
 from pydantic_core import Url
@@ -25,6 +26,9 @@ class Settings(BaseSettings):
     id: str = "A07JWHE9458"
     """Slack app id til boten"""
 
+    slack_api_url: AnyHttpUrl = Url("https://slack.com/api/")
+    """Endepunkt for Slack sitt Web API"""
+
     kbs_endpoint: AnyHttpUrl = Url("http://nks-kbs")
     """Endepunkt for NKS KBS"""
 
@@ -34,6 +38,19 @@ class Settings(BaseSettings):
     update_rate_limit: timedelta = timedelta(seconds=1.2)
     """Antall sekunder mellom hver oppdatering av `chat.update`"""
 
+    capture_file: Path | None = None
+    """Fil for opptak av hendelser og KBS strømmer, opptak er skrudd av hvis `None`"""
+
+    shutdown_timeout: float = 60.0
+    """Tidsbegrensning, i sekunder, på hvor lenge pågående svar får bli ferdige ved avslutning
+
+    MERK: `terminationGracePeriodSeconds` i `.nais/app.yaml` må være større enn
+    denne verdien pluss `lifecycle.ABORT_GRACE` og tid til siste oppdatering
+    """
+
+    health_port: int = 8080
+    """Port for helsesjekker fra NAIS"""
+
     # Variabler vi trenger for autentisering
     client_id: str = Field(
         "nks-slackbob", validation_alias=AliasChoices("azure_app_client_id")
@@ -0,0 +1,58 @@
+"""Felles oppsett for testene."""
+
+import json
+import threading
+from collections.abc import Callable, Iterator
+
+import pytest
+
+from nks_slackbob.lifecycle import InFlight
+from nks_slackbob.replay import Script, StubServer, connect_stubs
+
+QUESTION = "Hva er dagpenger?"
+"""Spørsmålet brukeren stiller i opptakene"""
+
+
+@pytest.fixture
+def make_script() -> Callable[..., Script]:
+    """Lag et opptak hvor KBS strømmer gitte tekster til gitte tidspunkt."""
+
+    def factory(*frames: tuple[float, str], session: str = "svar") -> Script:
+        return Script(
+            session=session,
+            handler="slack_mention",
+            event={"channel": "C1", "ts": "1.0", "text": QUESTION},
+            replies=[{"ok": True, "messages": [{"text": QUESTION}]}],
+            kbs_request=0.0,
+            kbs_status=(0.0, 200),
+            kbs_frames=[
+                (
+                    t,
+                    "data: "
+                    + json.dumps(
+                        {"answer": {"text": text, "citations": []}, "context": []}
+                    ),
+                )
+                for t, text in frames
+            ],
+        )
+
+    return factory
+
+
+@pytest.fixture
+def stubs(monkeypatch: pytest.MonkeyPatch) -> Iterator[StubServer]:
+    """Lokale stubber for KBS som `main` er koblet mot.
+
+    `main` får også en egen `InFlight` slik at avbrudd ikke lekker mellom
+    testene.
+    """
+    server = StubServer(speed=1.0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with connect_stubs(server):
+        from nks_slackbob import main
+
+        monkeypatch.setattr(main, "inflight", InFlight())
+        yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,62 @@
+"""Tester for opptak og avspilling av hendelser."""
+
+import json
+import pathlib
+
+from nks_slackbob import capture
+from nks_slackbob.capture import Recorder
+from nks_slackbob.replay import load
+
+
+def test_scrub_user_and_secrets(tmp_path: pathlib.Path) -> None:
+    """Sjekk at bruker-ID-er og hemmeligheter blir vasket bort."""
+    recorder = Recorder(tmp_path / "opptak.jsonl")
+    scrubbed = recorder.scrub(
+        {
+            "user": "U0G9QF9C6",
+            "text": "<@U0G9QF9C6> hei xoxb-123-abc",
+            "token": "hemmelig",
+            "user_profile": {"real_name": "Ola Nordmann", "display_name": "ola"},
+            "bot_profile": {"name": "Bob"},
+        }
+    )
+    assert "token" not in scrubbed
+    assert "user_profile" not in scrubbed
+    assert "bot_profile" not in scrubbed
+    assert "Ola" not in json.dumps(scrubbed)
+    assert "U0G9QF9C6" not in json.dumps(scrubbed)
+    assert "xoxb" not in scrubbed["text"]
+    # Samme bruker skal få samme pseudonym slik at avspilling fungerer
+    assert scrubbed["text"].startswith(f"<@{scrubbed['user']}>")
+
+
+def test_scrub_keeps_uppercase_words(tmp_path: pathlib.Path) -> None:
+    """Sjekk at vanlige ord med store bokstaver ikke blir tolket som brukere."""
+    recorder = Recorder(tmp_path / "opptak.jsonl")
+    assert recorder.scrub("UTBETALINGER") == "UTBETALINGER"
+
+
+def test_record_and_load(tmp_path: pathlib.Path) -> None:
+    """Sjekk at et opptak kan leses inn igjen for avspilling."""
+    path = tmp_path / "opptak.jsonl"
+    capture.setup_capture(path)
+    try:
+        with capture.session("slack_mention", {"ts": "1.0", "text": "Hei"}):
+            capture.record("replies", messages=[{"text": "Hei"}])
+            capture.record("kbs_request")
+            capture.record("kbs_status", status=200)
+            capture.record("kbs", frame='data: {"answer": {"text": "Hallo"}}')
+        # Utenfor en sesjon skal ingenting bli tatt opp
+        capture.record("kbs", frame="data: {}")
+    finally:
+        capture.close_capture()
+    # Simuler en avkuttet siste linje fra en prosess som ble drept
+    with path.open("a", encoding="utf-8") as fil:
+        fil.write('{"session": "abc", "kind": "kb')
+    (script,), skipped = load(path)
+    assert skipped == 1
+    assert script.handler == "slack_mention"
+    assert script.event["text"] == "Hei"
+    assert script.replies == [{"ok": True, "messages": [{"text": "Hei"}]}]
+    assert script.kbs_status is not None and script.kbs_status[1] == 200
+    assert len(script.kbs_frames) == 1
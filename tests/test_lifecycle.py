@@ -0,0 +1,163 @@
+"""Tester for ryddig avslutning av boten."""
+
+import datetime
+import threading
+from collections.abc import Callable
+from typing import Any, cast
+
+import httpx
+import pytest
+from slack_sdk import WebClient
+
+from nks_slackbob import settings
+from nks_slackbob.lifecycle import HealthServer, InFlight
+from nks_slackbob.replay import Result, Script, StubClient, StubServer
+
+
+def test_drain_waits_for_in_flight() -> None:
+    """Sjekk at `drain` venter til pågående hendelser er ferdige."""
+    inflight = InFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    @inflight.tracked
+    def handler(event: dict[str, str], client: object) -> None:
+        started.set()
+        release.wait()
+
+    thread = threading.Thread(target=handler, args=({}, None))
+    thread.start()
+    started.wait()
+    assert inflight.count == 1
+    assert not inflight.drain(0.01)
+    release.set()
+    assert inflight.drain(1.0)
+    assert inflight.count == 0
+    thread.join()
+
+
+def test_abort_signals_handlers() -> None:
+    """Sjekk at `abort` gir beskjed til pågående hendelser om å avslutte."""
+    inflight = InFlight()
+    started = threading.Event()
+
+    @inflight.tracked
+    def handler(event: dict[str, str], client: object) -> None:
+        started.set()
+        inflight.aborted.wait()
+
+    thread = threading.Thread(target=handler, args=({}, None))
+    thread.start()
+    started.wait()
+    assert inflight.abort()
+    thread.join()
+
+
+def test_finalize_from_main_thread() -> None:
+    """Sjekk at hovedtråden avslutter svar som henger, og bare én gang."""
+    inflight = InFlight()
+    started = threading.Event()
+    release = threading.Event()
+    finished: list[str] = []
+    claimed: list[object] = []
+
+    @inflight.tracked
+    def handler(event: dict[str, str], client: object) -> None:
+        inflight.on_abort(lambda: finished.append("avbrutt"))
+        started.set()
+        # Later som om vi henger i påvente av KBS og ignorerer avbrudd
+        release.wait()
+        claimed.append(inflight.claim())
+
+    thread = threading.Thread(target=handler, args=({}, None))
+    thread.start()
+    started.wait()
+    assert not inflight.abort(grace=0.01)
+    assert inflight.finalize() == 1
+    assert finished == ["avbrutt"]
+    release.set()
+    thread.join()
+    # Hendelseshåndtereren skal ikke oppdatere svaret igjen
+    assert claimed == [None]
+
+
+def test_isready() -> None:
+    """Sjekk at `/isready` kun svarer OK når vi er tilkoblet og ikke avslutter."""
+    connected = threading.Event()
+    health = HealthServer(0, connected=connected.is_set)
+    health.start()
+    url = f"http://127.0.0.1:{health.server_port}"
+    try:
+        assert httpx.get(f"{url}/isalive").status_code == 200
+        assert httpx.get(f"{url}/isready").status_code == 503
+        connected.set()
+        assert httpx.get(f"{url}/isready").status_code == 200
+        health.stopping.set()
+        assert httpx.get(f"{url}/isready").status_code == 503
+        assert httpx.get(f"{url}/isalive").status_code == 200
+    finally:
+        health.stop()
+
+
+def test_chat_without_answer(
+    stubs: StubServer, make_script: Callable[..., Script]
+) -> None:
+    """Sjekk at bruker får beskjed hvis KBS ikke sender noe svar."""
+    from nks_slackbob import main
+
+    stubs.script = make_script()
+    result = Result(session="svar", handler="slack_mention")
+    client = StubClient(stubs.script, result)
+    main.chat(cast(WebClient, client), stubs.script.event)
+    assert result.updates == 1
+    assert client.messages[-1] is not None
+    assert client.messages[-1].startswith("Fikk ikke noe svar")
+
+
+def test_chat_aborted_sends_partial_answer(
+    stubs: StubServer,
+    make_script: Callable[..., Script],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Sjekk at et avbrutt svar sender det vi har fått så langt."""
+    from nks_slackbob import main
+
+    # Oppdater for hver melding og be om avbrudd etter første oppdatering
+    monkeypatch.setattr(settings, "update_rate_limit", datetime.timedelta(0))
+
+    class AbortingClient(StubClient):
+        def chat_update(self, **kwargs: Any) -> dict[str, Any]:
+            main.inflight.aborted.set()
+            return super().chat_update(**kwargs)
+
+    stubs.script = make_script((0.0, "Dagpenger"), (0.05, "Dagpenger er penger"))
+    result = Result(session="svar", handler="slack_mention")
+    client = AbortingClient(stubs.script, result)
+    main.chat(cast(WebClient, client), stubs.script.event)
+    assert client.messages == [
+        "Dagpenger",
+        "Dagpenger\n\n_Svaret ble avbrutt fordi jeg starter på nytt, prøv igjen om litt_",
+    ]
+
+
+def test_chat_does_not_overwrite_finalized_answer(
+    stubs: StubServer,
+    make_script: Callable[..., Script],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Sjekk at feilmeldinger ikke overskriver svar hovedtråden har avsluttet."""
+    from nks_slackbob import main
+
+    def finalize_then_fail(url: httpx.URL) -> bool:
+        # Hovedtråden avslutter svaret mens vi sjekker om KBS kjører
+        main.inflight.finalize()
+        return False
+
+    monkeypatch.setattr(main, "is_bob_alive", finalize_then_fail)
+    stubs.script = make_script()
+    result = Result(session="svar", handler="slack_mention")
+    client = StubClient(stubs.script, result)
+    main.chat(cast(WebClient, client), stubs.script.event)
+    assert len(client.messages) == 1
+    assert client.messages[0] is not None
+    assert client.messages[0].startswith("Jeg startet på nytt")
@@ -0,0 +1,81 @@
+"""Tester for avspilling av opptak."""
+
+from collections.abc import Callable
+from typing import Any
+
+from nks_slackbob import settings
+from nks_slackbob.replay import Script, _summary, report, run
+
+
+def _result(
+    session: str, updates: int, last: float | None, first: float | None = None
+) -> dict[str, Any]:
+    """Lag et resultat slik det blir lagret av `main`."""
+    return {
+        "session": session,
+        "handler": "slack_mention",
+        "updates": updates,
+        "first_update": first if first is not None else last,
+        "last_update": last,
+        "error": None,
+    }
+
+
+def test_run_measures_updates(make_script: Callable[..., Script]) -> None:
+    """Sjekk at avspilling går gjennom hendelseshåndtererne og måler svar."""
+    rate_limit = settings.update_rate_limit
+    scripts = [
+        make_script((0.1, "Dag"), (2.0, "Dagpenger")),
+        # Meldinger med '@bob' besvares av 'slack_mention' og skal ignoreres
+        Script(
+            session="mention",
+            handler="thread_reply",
+            event={"channel": "C1", "ts": "1.0", "text": "<@U07ABCDEF1> hei"},
+            users={"U07ABCDEF1": settings.id},
+        ),
+    ]
+    svar, mention = run(scripts, speed=10.0)
+    assert svar.error is None
+    # Rate-limit skaleres med hastigheten, så som i sanntid kommer første
+    # melding før rate-limit og andre etter, i tillegg til det endelige svaret
+    assert svar.updates == 2
+    assert svar.last_update is not None
+    # Siste melding kommer etter 2 sekunder i opptaket, altså 0.2 med 10x
+    assert 0.2 <= svar.last_update < 2.0
+    assert mention.error is None
+    assert mention.updates == 0
+    # Innstillinger blir satt tilbake etter avspilling
+    assert settings.update_rate_limit == rate_limit
+
+
+def test_summary_p95_within_measurements() -> None:
+    """Sjekk at p95 ikke ekstrapolerer utover målingene for små opptak."""
+    summary = _summary([_result("a", 1, 1.0), _result("b", 1, 2.979)])
+    assert summary["last_update_p95"] is not None
+    assert summary["last_update_p95"] <= 2.979
+
+
+def test_report_with_baseline() -> None:
+    """Sjekk at rapporten viser endringer mot sammenligningsgrunnlaget."""
+    baseline = [_result("a", 3, 2.0), _result("b", 1, 1.0)]
+    results = [_result("a", 2, 1.5), _result("b", 1, 1.0)]
+    lines = report(results, baseline).splitlines()
+    assert lines[1].split() == ["updates", "3", "4", "-1"]
+    # Kun sesjonen som endret seg blir listet
+    assert lines[-1] == (
+        "a (slack_mention): oppdateringer 3 -> 2, første oppdatering "
+        "2.000 -> 1.500 (-0.500), siste oppdatering 2.000 -> 1.500 (-0.500)"
+    )
+
+
+def test_report_latency_regression() -> None:
+    """Sjekk at sesjoner hvor bare tiden har blitt verre blir listet."""
+    baseline = [_result("a", 2, 2.0, first=1.0), _result("b", 2, 1.0)]
+    results = [_result("a", 2, 3.0, first=1.02), _result("b", 2, 1.05)]
+    lines = report(results, baseline).splitlines()
+    # Små endringer innenfor toleransen skal ikke listes
+    assert not any(line.startswith("b ") for line in lines)
+    assert lines[-1] == (
+        "a (slack_mention): oppdateringer 2 -> 2, første oppdatering "
+        "1.000 -> 1.020 (+0.020), siste oppdatering 2.000 -> 3.000 (+1.000)"
+    )